@@ -1,6 +1,14 @@
+import argparse
+import glob
+import hashlib
+import json
 import os
-import re
+import sys
+import threading
 import time
+import uuid
+import zlib
+from contextlib import contextmanager
 from socket import gethostname
 
 import pandas as pd
@@ -15,7 +23,17 @@ from bs4 import BeautifulSoup
 import hdbscan
 import umap.umap_ as umap
 from sentence_transformers import SentenceTransformer
-from sklearn.preprocessing import StandardScaler
+from sklearn.decomposition import PCA
+from sklearn.preprocessing import StandardScaler, normalize
+
+try:
+    import pyarrow  # noqa: F401  (optional: Arrow-backed string columns)
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+from instrumentation import api_execute, count, span, summary, write_report
+from metadata_cache import spreadsheet_id_cache
 
 # ====== CONFIG ======
 # Denodo connection
@@ -40,8 +58,33 @@ SELECT tv.ticketid, tv.title, tv.description, tv.kbarticlesubject, tv.kbarticlei
    AND tv.sourcename IN ('Systems', 'Email', 'Web');
 """
 MIN_GROUP_SIZE = 30
+# Size-aware reduction: PCA up to SMALL_GROUP_SIZE tickets, full UMAP up to
+# LARGE_GROUP_SIZE, above that UMAP fitted on a UMAP_SAMPLE_SIZE subsample.
+SMALL_GROUP_SIZE = 200
+LARGE_GROUP_SIZE = 5000
+UMAP_SAMPLE_SIZE = 3000
+PCA_COMPONENTS = 10
+UMAP_COMPONENTS = 30
+RANDOM_STATE = 42
+# Seeding UMAP makes umap-learn run single-threaded, so it is opt-in
+# (KB_UMAP_SEED=42) for when reproducible cluster labels matter more than speed.
+UMAP_SEED = int(os.environ["KB_UMAP_SEED"]) if os.environ.get("KB_UMAP_SEED") else None
+KB_ARTICLE_URL = "https://teamdynamix.umich.edu/TDClient/30/Portal/KB/ArticleDet.aspx?ID={}"
+TICKET_COLUMNS = [
+    "Ticket ID", "Title", "Description",
+    "Knowledge Base Article", "KB Article ID",
+]
+# Store Title/Description as Arrow strings (needs pyarrow); set KB_ARROW_STRINGS=1
+ARROW_STRINGS = os.environ.get("KB_ARROW_STRINGS") == "1"
 CLUSTER_OUTPUT_FOLDER = "clustered_output"
 FINAL_OUTPUT = os.path.join(CLUSTER_OUTPUT_FOLDER, "final_clustered_dataset.csv")
+# Shard mode: partial outputs and claim files live here (shared storage)
+SHARD_FOLDER = os.path.join(CLUSTER_OUTPUT_FOLDER, "shards")
+SHARD_READ_CHUNKSIZE = 100000
+# A worker touches the locks it holds this often (at most) so they never look stale
+LOCK_HEARTBEAT_S = 60
+# Rendered ticket-example text per article, reused while its tickets/clusters are unchanged
+RENDER_CACHE = os.path.join(CLUSTER_OUTPUT_FOLDER, "render_cache.json")
 TRACKING_SHEETS = [
     "Public Tracking",
     "UM-Login Tracking",
@@ -54,6 +97,10 @@ SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets'
 ]
 
+# Run report (JSON) and optional Prometheus textfile-collector output
+RUN_REPORT = os.environ.get("KB_RUN_REPORT", "cluster_run_report.json")
+PROM_TEXTFILE = os.environ.get("KB_PROM_TEXTFILE")
+
 
 # ====== UTILITY FUNCTIONS ======
 
@@ -73,30 +120,216 @@ def connect_denodo(db_user, db_password):
     )
 
 
+def kb_article_link(article_id):
+    return KB_ARTICLE_URL.format(article_id)
+
+
+def compact_ticket_frame(df, arrow_strings=ARROW_STRINGS):
+    """
+    Shrinks a ticket frame in place of the default object dtypes: integer IDs,
+    categorical article labels and, optionally, Arrow-backed long text. The
+    per-row link column is dropped; use with_article_links() when needed.
+    """
+    df = df.drop(columns=["Knowledge Base Article Links"], errors="ignore")
+    for col in ("Ticket ID", "KB Article ID"):
+        if col in df:
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+    if "Knowledge Base Article" in df:
+        df["Knowledge Base Article"] = df["Knowledge Base Article"].astype("category")
+    if "Cluster" in df:
+        df["Cluster"] = pd.to_numeric(df["Cluster"], downcast="integer")
+    if "Reduction" in df:
+        df["Reduction"] = df["Reduction"].astype("category")
+    if arrow_strings and HAVE_PYARROW:
+        for col in ("Title", "Description"):
+            if col in df:
+                df[col] = df[col].astype("string[pyarrow]")
+    return df
+
+
+def with_article_links(df):
+    """Returns `df` with the 'Knowledge Base Article Links' column derived from 'KB Article ID'."""
+    ids = df["KB Article ID"].unique()
+    links = pd.Series([kb_article_link(i) for i in ids], index=ids)
+    return df.assign(**{"Knowledge Base Article Links": df["KB Article ID"].map(links)})
+
+
+def write_ticket_csv(df, path):
+    # the notebooks still read the link column, so materialize it only on disk
+    with span("csv.write"):
+        with_article_links(df).to_csv(path, index=False)
+
+
+def read_ticket_csv(path):
+    with span("csv.read"):
+        df = pd.read_csv(
+            path,
+            usecols=lambda c: c != "Knowledge Base Article Links",
+            dtype={"Knowledge Base Article": "category"},
+        )
+    return compact_ticket_frame(df)
+
+
+def shard_of(article_ids, n_shards):
+    """
+    Stable shard number for each KB Article ID (crc32, so identical on every
+    node). IDs are hashed as integers, so 5000 and 5000.0 land in the same
+    shard whatever dtype a chunk was parsed with; nulls must be dropped first.
+    """
+    ids = pd.Series(article_ids)
+    if ids.isna().any():
+        raise ValueError("shard_of() needs non-null KB Article IDs")
+    ids = pd.to_numeric(ids).astype("int64")
+    return np.array([zlib.crc32(str(a).encode()) % n_shards for a in ids])
+
+
+def read_ticket_shard(path, shard, n_shards):
+    """Reads only the rows of `path` whose article falls in `shard`, chunk by chunk."""
+    parts = []
+    with span("csv.read"):
+        for chunk in pd.read_csv(
+            path,
+            usecols=lambda c: c != "Knowledge Base Article Links",
+            chunksize=SHARD_READ_CHUNKSIZE,
+        ):
+            # tickets without an article can't be grouped; cluster_frame() drops them too
+            missing = chunk["KB Article ID"].isna()
+            if missing.any():
+                count("tickets_without_article", int(missing.sum()))
+                chunk = chunk[~missing]
+            keep = shard_of(chunk["KB Article ID"], n_shards) == shard
+            parts.append(compact_ticket_frame(chunk[keep]))
+    if not parts:
+        return read_ticket_csv(path)
+    df = pd.concat(parts, ignore_index=True)
+    df["Knowledge Base Article"] = df["Knowledge Base Article"].astype("category")
+    return df
+
+
+def shard_input_path(shard, n_shards, shard_folder=SHARD_FOLDER):
+    return os.path.join(shard_folder, f"input-{shard:04d}-of-{n_shards:04d}.csv")
+
+
+def partition_tickets(path, n_shards, shard_folder=SHARD_FOLDER):
+    """
+    Splits the ticket CSV into one input file per shard in a single chunked
+    pass, so a worker reads only the shards it claims instead of rescanning
+    `path` for each. Files are written aside and renamed once complete.
+    """
+    os.makedirs(shard_folder, exist_ok=True)
+    tmps = {s: f"{shard_input_path(s, n_shards, shard_folder)}.{gethostname()}.{os.getpid()}.tmp"
+            for s in range(n_shards)}
+    written = set()
+    with span("shard.partition"):
+        for chunk in pd.read_csv(
+            path,
+            usecols=lambda c: c != "Knowledge Base Article Links",
+            chunksize=SHARD_READ_CHUNKSIZE,
+        ):
+            missing = chunk["KB Article ID"].isna()
+            if missing.any():
+                count("tickets_without_article", int(missing.sum()))
+                chunk = chunk[~missing]
+            chunk = chunk.astype({"KB Article ID": "int64"})
+            for shard, part in chunk.groupby(shard_of(chunk["KB Article ID"], n_shards)):
+                first = shard not in written
+                part.to_csv(tmps[shard], mode="w" if first else "a", header=first, index=False)
+                written.add(shard)
+        for shard, tmp in tmps.items():
+            if shard not in written:
+                pd.DataFrame(columns=TICKET_COLUMNS).to_csv(tmp, index=False)
+            os.replace(tmp, shard_input_path(shard, n_shards, shard_folder))
+    print(f"Partitioned {path} into {n_shards} shard inputs in {shard_folder}")
+
+
 def fetch_ticket_kb_articles(db_user, db_password,
                              output_csv="ticket_kb_articles.csv"):
     os.makedirs(CLUSTER_OUTPUT_FOLDER, exist_ok=True)
-    cnxn = connect_denodo(db_user, db_password)
+    with span("denodo.connect"):
+        cnxn = connect_denodo(db_user, db_password)
     cur = cnxn.cursor()
-    cur.execute(QUERY)
-    rows = [list(r) for r in cur.fetchall()]
-    # append the link
-    for row in rows:
-        row.append(f"https://teamdynamix.umich.edu/TDClient/30/Portal/KB/ArticleDet.aspx?ID={row[4]}")
-    cols = [
-        "Ticket ID", "Title", "Description",
-        "Knowledge Base Article", "KB Article ID",
-        "Knowledge Base Article Links"
-    ]
-    df = pd.DataFrame(rows, columns=cols)
-    df.to_csv(output_csv, index=False)
+    with span("denodo.query"):
+        cur.execute(QUERY)
+        rows = cur.fetchall()
+    count("rows_fetched", len(rows), query="tickets")
+    df = compact_ticket_frame(pd.DataFrame.from_records(rows, columns=TICKET_COLUMNS))
+    del rows
+    write_ticket_csv(df, output_csv)
     cnxn.close()
     return df
 
 
+def reduce_embeddings(emb):
+    """
+    Reduces one article group's embeddings with a method sized to the group.
+    Returns (reduced, path) where path is 'pca', 'umap' or 'umap-sample'.
+    """
+    n = len(emb)
+    if n <= SMALL_GROUP_SIZE:
+        with span("cluster.pca"):
+            pca = PCA(n_components=min(PCA_COMPONENTS, n - 1), random_state=RANDOM_STATE)
+            return pca.fit_transform(normalize(emb)), "pca"
+
+    reducer = umap.UMAP(
+        n_neighbors=15,
+        n_components=UMAP_COMPONENTS,
+        metric="cosine",
+        init="random",
+        random_state=UMAP_SEED
+    )
+    if n <= LARGE_GROUP_SIZE:
+        with span("cluster.umap"):
+            return reducer.fit_transform(emb), "umap"
+
+    sample = np.random.default_rng(RANDOM_STATE).choice(n, UMAP_SAMPLE_SIZE, replace=False)
+    with span("cluster.umap"):
+        reducer.fit(emb[sample])
+        return reducer.transform(emb), "umap-sample"
+
+
+def label_embeddings(emb):
+    """
+    HDBSCAN labels for one group plus the reduction path taken. If the
+    reduction fails, clusters the L2-normalized embeddings directly ('direct',
+    euclidean there is equivalent to cosine); only if that fails too is the
+    whole group labelled -1 ('failed').
+    """
+    hdb = dict(min_cluster_size=5, min_samples=3, metric="euclidean")
+    try:
+        reduced, path = reduce_embeddings(emb)
+        with span("cluster.hdbscan"):
+            sc = StandardScaler().fit_transform(reduced)
+            return hdbscan.HDBSCAN(**hdb).fit_predict(sc), path
+    except Exception as e:
+        print(f"Reduction failed for group of {len(emb)}; clustering directly: {e}")
+    try:
+        with span("cluster.hdbscan"):
+            return hdbscan.HDBSCAN(**hdb).fit_predict(normalize(emb)), "direct"
+    except Exception as e:
+        print(f"Clustering failed for group of {len(emb)}: {e}")
+        return np.full(len(emb), -1), "failed"
+
+
 def cluster_articles(input_csv):
-    df = pd.read_csv(input_csv)
+    df = read_ticket_csv(input_csv)
     df = df[:25000]
+    df_clustered = cluster_frame(df)
+    os.makedirs(CLUSTER_OUTPUT_FOLDER, exist_ok=True)
+    write_ticket_csv(df_clustered, FINAL_OUTPUT)
+    print(f"All clustering done. Saved to {FINAL_OUTPUT}")
+    return df_clustered
+
+
+def load_sentence_model():
+    with span("model.load"):
+        return SentenceTransformer("all-MiniLM-L6-v2")
+
+
+def cluster_frame(df, model=None):
+    """
+    Assigns a Cluster label (and Reduction path) to every ticket in `df`.
+    Pass `model` to reuse an already loaded encoder across calls.
+    """
     counts = df['KB Article ID'].value_counts()
     ids_gt = counts[counts > MIN_GROUP_SIZE].index
     ids_le = counts[counts <= MIN_GROUP_SIZE].index
@@ -104,42 +337,218 @@ def cluster_articles(input_csv):
     df_gt = df[df['KB Article ID'].isin(ids_gt)]
     df_le = df[df['KB Article ID'].isin(ids_le)]
 
-    model = SentenceTransformer("all-MiniLM-L6-v2")
+    if model is None:
+        model = load_sentence_model()
     clustered = []
 
     for aid in ids_gt:
         grp = df_gt[df_gt['KB Article ID'] == aid].copy()
-        try:
+        with span("cluster.encode"):
             et = model.encode(grp['Title'].astype(str).tolist(),
                               show_progress_bar=False)
             ed = model.encode(grp['Description'].astype(str).tolist(),
                               show_progress_bar=False)
-            emb = np.hstack([et, ed])
-            um = umap.UMAP(
-                n_neighbors=15,
-                n_components=30,
-                metric="cosine",
-                init="random"
-            ).fit_transform(emb)
-            sc = StandardScaler().fit_transform(um)
-            lbls = hdbscan.HDBSCAN(
-                min_cluster_size=5,
-                min_samples=3,
-                metric="euclidean"
-            ).fit_predict(sc)
-            grp['Cluster'] = lbls
-        except Exception:
-            grp['Cluster'] = -1
+        count("encodes", 2 * len(grp))
+        lbls, path = label_embeddings(np.hstack([et, ed]))
+        grp['Cluster'] = lbls
+        grp['Reduction'] = path
+        count("reduction_path", path=path)
+        if path == "failed":
+            count("cluster_failures")
+        count("articles_clustered")
         clustered.append(grp)
 
-    df_clustered = pd.concat(clustered + [df_le.assign(Cluster=-1)],
-                             ignore_index=True)
-    os.makedirs(CLUSTER_OUTPUT_FOLDER, exist_ok=True)
-    df_clustered.to_csv(FINAL_OUTPUT, index=False)
-    print(f"All clustering done. Saved to {FINAL_OUTPUT}")
+    df_clustered = compact_ticket_frame(
+        pd.concat(clustered + [df_le.assign(Cluster=-1, Reduction="none")],
+                  ignore_index=True)
+    )
+    paths = df_clustered.drop_duplicates('KB Article ID')['Reduction'].value_counts()
+    print("Articles per reduction path: " + ", ".join(f"{p}={n}" for p, n in paths.items()))
     return df_clustered
 
 
+# ====== SHARDED CLUSTERING ======
+# Every worker points at the same input CSV and SHARD_FOLDER on shared
+# storage. A shard is claimed by atomically creating its .lock file and is
+# done once its part-*.csv exists, so workers on any node can simply be
+# started with --shard-worker until no shard is left. Held locks are touched
+# periodically, so only a dead worker's lock outlives --stale-after.
+
+def shard_part_path(shard, n_shards, shard_folder=SHARD_FOLDER):
+    return os.path.join(shard_folder, f"part-{shard:04d}-of-{n_shards:04d}.csv")
+
+
+def claim_shard(shard, n_shards, shard_folder=SHARD_FOLDER, stale_after=None):
+    """
+    Tries to claim `shard`. Returns the owner token written into the lock, or
+    None if the shard is finished or held by another worker. Locks not touched
+    for `stale_after` seconds are treated as abandoned.
+    """
+    part = shard_part_path(shard, n_shards, shard_folder)
+    lock = part + ".lock"
+    if os.path.exists(part):
+        return None
+    try:
+        stale = stale_after is not None and time.time() - os.path.getmtime(lock) > stale_after
+    except FileNotFoundError:
+        stale = False
+    if stale:
+        reclaim_stale_lock(lock, stale_after)
+    try:
+        fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    token = uuid.uuid4().hex
+    with os.fdopen(fd, "w") as f:
+        json.dump({"token": token, "host": gethostname(), "pid": os.getpid(),
+                   "claimed": time.time()}, f)
+    return token
+
+
+def lock_token(lock):
+    """Owner token of `lock`, or None if it is gone or unreadable."""
+    try:
+        with open(lock) as f:
+            return json.load(f).get("token")
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def reclaim_stale_lock(lock, stale_after):
+    """
+    Moves an abandoned lock aside. The rename is atomic, so of several workers
+    that saw the same stale lock only one moves it. If what was moved turns
+    out to be a fresh lock (another worker reclaimed the shard in between),
+    it is put back instead of being deleted.
+    """
+    stale_token = lock_token(lock)
+    aside = f"{lock}.{uuid.uuid4().hex}.stale"
+    try:
+        os.rename(lock, aside)
+    except FileNotFoundError:
+        return
+    if lock_token(aside) == stale_token and time.time() - os.path.getmtime(aside) > stale_after:
+        print(f"Reclaimed stale lock {lock}")
+    else:
+        try:
+            os.link(aside, lock)  # unlike rename, never replaces an existing lock
+        except FileExistsError:
+            pass
+    os.remove(aside)
+
+
+@contextmanager
+def lock_heartbeat(lock, token, interval=LOCK_HEARTBEAT_S):
+    """Touches `lock` every `interval` seconds while it still holds `token`."""
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(interval):
+            if lock_token(lock) != token:
+                return
+            try:
+                os.utime(lock)
+            except FileNotFoundError:
+                return
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def release_shard(shard, n_shards, token, shard_folder=SHARD_FOLDER):
+    """
+    Removes the shard's lock only if it still holds `token`; a worker that
+    reclaimed the shard after --stale-after keeps its own lock.
+    """
+    lock = shard_part_path(shard, n_shards, shard_folder) + ".lock"
+    if lock_token(lock) == token:
+        try:
+            os.remove(lock)
+        except FileNotFoundError:
+            pass
+
+
+def cluster_shard(input_csv, shard, n_shards, shard_folder=SHARD_FOLDER, model=None):
+    """Clusters one shard and writes its partial output (atomically)."""
+    shard_input = shard_input_path(shard, n_shards, shard_folder)
+    if os.path.exists(shard_input) and os.path.getmtime(shard_input) >= os.path.getmtime(input_csv):
+        df = read_ticket_csv(shard_input)
+    else:
+        # not partitioned (or partitioned from an older fetch): scan the whole input
+        df = read_ticket_shard(input_csv, shard, n_shards)
+    print(f"Shard {shard}/{n_shards}: {len(df)} tickets, "
+          f"{df['KB Article ID'].nunique()} articles")
+    df_clustered = cluster_frame(df, model) if len(df) else df.assign(Cluster=-1, Reduction="none")
+    part = shard_part_path(shard, n_shards, shard_folder)
+    tmp = f"{part}.{gethostname()}.{os.getpid()}.tmp"
+    write_ticket_csv(df_clustered, tmp)
+    os.replace(tmp, part)
+    count("shards_clustered")
+    return part
+
+
+def run_shard_worker(input_csv, n_shards, shards=None, shard_folder=SHARD_FOLDER,
+                     stale_after=None):
+    """
+    Claims and clusters shards (all of them, or just `shards`) until none are
+    left. The encoder is loaded once, on the first claimed shard. Returns the
+    written part files and the shard numbers that failed.
+    """
+    os.makedirs(shard_folder, exist_ok=True)
+    done = []
+    failed = []
+    model = None
+    heartbeat = LOCK_HEARTBEAT_S if stale_after is None else min(LOCK_HEARTBEAT_S, stale_after / 4)
+    for shard in (range(n_shards) if shards is None else shards):
+        token = claim_shard(shard, n_shards, shard_folder, stale_after)
+        if token is None:
+            continue
+        lock = shard_part_path(shard, n_shards, shard_folder) + ".lock"
+        try:
+            with lock_heartbeat(lock, token, heartbeat):
+                if model is None:
+                    model = load_sentence_model()
+                with span("shard", shard=str(shard)):
+                    done.append(cluster_shard(input_csv, shard, n_shards, shard_folder, model))
+        except Exception as e:
+            # leave the shard unclaimed so this or another worker can retry it
+            print(f"Shard {shard}/{n_shards} failed: {e}")
+            count("shard_failures")
+            failed.append(shard)
+        finally:
+            release_shard(shard, n_shards, token, shard_folder)
+    print(f"Worker finished {len(done)} shard(s), {len(failed)} failed"
+          + (f": {failed}" if failed else ""))
+    return done, failed
+
+
+def merge_shards(n_shards, shard_folder=SHARD_FOLDER, output=FINAL_OUTPUT):
+    """
+    Assembles the partial outputs into `output`, ordered by article and ticket
+    so the result does not depend on which worker ran which shard.
+    """
+    parts = [shard_part_path(s, n_shards, shard_folder) for s in range(n_shards)]
+    missing = [p for p in parts if not os.path.exists(p)]
+    if missing:
+        raise FileNotFoundError(f"{len(missing)} of {n_shards} shard outputs missing, e.g. {missing[0]}")
+    extra = set(glob.glob(os.path.join(shard_folder, "part-*.csv"))) - set(parts)
+    if extra:
+        print(f"Ignoring {len(extra)} part files from a different shard count")
+    df = pd.concat([read_ticket_csv(p) for p in parts], ignore_index=True)
+    df = compact_ticket_frame(
+        df.sort_values(["KB Article ID", "Ticket ID"], kind="mergesort", ignore_index=True)
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    write_ticket_csv(df, output)
+    print(f"Merged {n_shards} shards into {output}")
+    return df
+
+
 def authenticate():
     return service_account.Credentials.from_service_account_file(
         GOOGLE_CRED_FILE, scopes=SCOPES
@@ -147,8 +556,9 @@ def authenticate():
 
 
 def clean_html(html):
-    return BeautifulSoup(html or '', 'html.parser') \
-        .get_text(separator=' ', strip=True)
+    with span("html.clean"):
+        return BeautifulSoup(html or '', 'html.parser') \
+            .get_text(separator=' ', strip=True)
 
 
 def load_tracking_dict_from_spreadsheet(spreadsheet_title, folder_id=None):
@@ -157,29 +567,35 @@ def load_tracking_dict_from_spreadsheet(spreadsheet_title, folder_id=None):
         gc = gspread.authorize(creds)
 
         if folder_id:
-            drive_service = build('drive', 'v3', credentials=creds)
-            query = (
-                f"'{folder_id}' in parents and "
-                f"name = '{spreadsheet_title}' and "
-                "mimeType = 'application/vnd.google-apps.spreadsheet'"
-            )
-            results = drive_service.files().list(
-                q=query,
-                spaces='drive',
-                fields='files(id, name)',
-                supportsAllDrives=True,
-                includeItemsFromAllDrives=True
-            ).execute()
-            files = results.get('files', [])
-            if not files:
-                print(f"Spreadsheet '{spreadsheet_title}' not found in folder.")
-                return {}
-            spreadsheet = gc.open_by_key(files[0]['id'])
+            file_id = spreadsheet_id_cache.get((folder_id, spreadsheet_title))
+            if not file_id:
+                drive_service = build('drive', 'v3', credentials=creds)
+                query = (
+                    f"'{folder_id}' in parents and "
+                    f"name = '{spreadsheet_title}' and "
+                    "mimeType = 'application/vnd.google-apps.spreadsheet'"
+                )
+                results = api_execute("files.list", drive_service.files().list(
+                    q=query,
+                    spaces='drive',
+                    fields='files(id, name)',
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True
+                ))
+                files = results.get('files', [])
+                if not files:
+                    print(f"Spreadsheet '{spreadsheet_title}' not found in folder.")
+                    return {}
+                file_id = files[0]['id']
+                spreadsheet_id_cache.put((folder_id, spreadsheet_title), file_id)
+            spreadsheet = gc.open_by_key(file_id)
         else:
             spreadsheet = gc.open(spreadsheet_title)
 
         sheet = spreadsheet.sheet1
-        df = get_as_dataframe(sheet, dtype=str, na_values=[]).dropna(how='all')
+        with span("sheets.read"):
+            df = get_as_dataframe(sheet, dtype=str, na_values=[]).dropna(how='all')
+        count("api_calls", method="sheets.read")
         df.set_index('Article ID', inplace=True)
         return df.to_dict(orient='index')
     except Exception as e:
@@ -197,14 +613,15 @@ def batch_update_with_retries(doc_service, document_id, body,
     """
     for attempt in range(1, max_attempts + 1):
         try:
-            return doc_service.documents().batchUpdate(
+            return api_execute("documents.batchUpdate", doc_service.documents().batchUpdate(
                 documentId=document_id,
                 body=body
-            ).execute()
+            ))
         except HttpError as e:
             status = getattr(e.resp, "status", None)
             if status == 429 and attempt < max_attempts:
                 print(f"[Attempt {attempt}] Rate limit hit; retrying in {wait_seconds}s...")
+                count("retries", method="documents.batchUpdate")
                 time.sleep(wait_seconds)
             else:
                 print(f"[Attempt {attempt}] Error: {e}")
@@ -214,7 +631,7 @@ def batch_update_with_retries(doc_service, document_id, body,
 def update_google_doc(doc_id, content):
     creds = authenticate()
     doc_service = build('docs', 'v1', credentials=creds)
-    doc = doc_service.documents().get(documentId=doc_id).execute()
+    doc = api_execute("documents.get", doc_service.documents().get(documentId=doc_id))
     end_index = doc['body']['content'][-1]['endIndex']
     body = {
         'requests': [{
@@ -224,11 +641,81 @@ def update_google_doc(doc_id, content):
             }
         }]
     }
-    return batch_update_with_retries(doc_service, doc_id, body) is not None
+    if batch_update_with_retries(doc_service, doc_id, body) is None:
+        return False
+    count("bytes_written", len(content.encode()))
+    return True
+
+
+def group_render_key(group):
+    """
+    Identifies a group's rendered text by the ticket IDs, titles and
+    descriptions it is rendered from, taken in Ticket ID order since QUERY
+    returns rows in no fixed order. Edited tickets therefore re-render.
+    """
+    group = group.sort_values('Ticket ID', kind='mergesort')
+    # same normalization as the rendering, so object and Arrow strings hash alike
+    cols = pd.DataFrame({
+        'Ticket ID': group['Ticket ID'].astype(np.int64),
+        'Title': group['Title'].astype(object).fillna('').astype(str),
+        'Description': group['Description'].astype(object).fillna('').astype(str),
+    })
+    row_hashes = pd.util.hash_pandas_object(cols, index=False).to_numpy()
+    return hashlib.sha1(row_hashes.tobytes()).hexdigest()
+
+
+def load_render_cache(path=RENDER_CACHE):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_render_cache(cache, path=RENDER_CACHE):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp, path)
+
+
+def render_ticket_examples(df, cache):
+    """
+    Returns {article_id: text} listing each article's tickets as
+    "- Title: ...\\n  Description: ...\\n" lines. Only groups whose render key
+    changed are rendered, column-wise: each distinct description is cleaned
+    once and the lines are joined per group in Ticket ID order. `cache` is
+    updated in place and pruned to the articles in `df`.
+    """
+    df = df.sort_values(['KB Article ID', 'Ticket ID'], kind='mergesort')
+    keys = {str(aid): group_render_key(g)
+            for aid, g in df.groupby('KB Article ID', sort=False)}
+    stale = {aid for aid, key in keys.items() if cache.get(aid, {}).get('key') != key}
+    count("render_cache_hits", len(keys) - len(stale))
+    count("render_cache_misses", len(stale))
+
+    for aid in set(cache) - set(keys):
+        del cache[aid]
+    if not stale:
+        return {aid: cache[aid]['text'] for aid in keys}
+
+    sub = df[df['KB Article ID'].astype(str).isin(stale)]
+    desc = sub['Description']
+    distinct = desc.dropna().unique()
+    cleaned = pd.Series([clean_html(d) for d in distinct], index=distinct, dtype=object)
+    # nulls render as empty text (astype(str) alone keeps NaN on pandas 3, '<NA>' on Arrow strings)
+    title = sub['Title'].astype(object).fillna('').astype(str)
+    lines = ("- Title: " + title
+             + "\n  Description: " + desc.map(cleaned).fillna('').astype(str) + "\n")
+    rendered = lines.groupby(sub['KB Article ID'], sort=False).agg(''.join)
+    for aid, text in rendered.items():
+        cache[str(aid)] = {'key': keys[str(aid)], 'text': text}
+    return {aid: cache[aid]['text'] for aid in keys}
 
 
 def update_docs_from_clusters():
-    df = pd.read_csv(FINAL_OUTPUT)
+    df = read_ticket_csv(FINAL_OUTPUT)
     creds = authenticate()
     doc_service = build('docs', 'v1', credentials=creds)
     tracking_um = load_tracking_dict_from_spreadsheet(
@@ -236,16 +723,25 @@ def update_docs_from_clusters():
     )
     sources = [tracking_um]
 
+    # only articles with a tracked doc get rendered
+    tracked = {aid for t in sources for aid in t}
+    if not tracked:
+        # an empty dict is also what a failed sheet load returns; keep the render cache
+        print("No tracked articles loaded; nothing to update.")
+        return
+    df = df[df['KB Article ID'].astype(str).isin(tracked)]
+    render_cache = load_render_cache()
+    with span("docs.render"):
+        rendered = render_ticket_examples(df, render_cache)
+    save_render_cache(render_cache)
+
     start_marker = "Example Requests and Incidents that were resolved using the above article"
     end_marker   = "end"
 
-    for (article, link), group in df.groupby([
-        'Knowledge Base Article', 'Knowledge Base Article Links'
-    ]):
-        m = re.search(r'ID=([\w-]+)', link)
-        if not m: 
-            continue
-        article_id = m.group(1)
+    articles = df[['Knowledge Base Article', 'KB Article ID']].drop_duplicates() \
+        .sort_values(['Knowledge Base Article', 'KB Article ID'])
+    for article, aid in articles.itertuples(index=False):
+        article_id = str(aid)
 
         # look up doc_id
         doc_id = next(
@@ -256,7 +752,7 @@ def update_docs_from_clusters():
             continue
 
         # fetch the doc once
-        doc = doc_service.documents().get(documentId=doc_id).execute()
+        doc = api_execute("documents.get", doc_service.documents().get(documentId=doc_id))
         content = doc.get('body', {}).get('content', [])
         end_index = doc['body']['content'][-1]['endIndex']
 
@@ -296,17 +792,12 @@ def update_docs_from_clusters():
             footer = f"{end_marker}\n"
 
         # build the insertText request
-        text_lines = [header, "\n\n"]
-        for _, row in group.iterrows():
-            desc = clean_html(row['Description']) if pd.notna(row['Description']) else ''
-            text_lines.append(f"- Title: {row['Title']}\n")
-            text_lines.append(f"  Description: {desc}\n")
-        text_lines.append(footer)
+        text = f"{header}\n\n{rendered[article_id]}{footer}"
 
         requests.append({
             'insertText': {
                 'location': {'index': insert_at},
-                'text': ''.join(text_lines)
+                'text': text
             }
         })
 
@@ -314,21 +805,89 @@ def update_docs_from_clusters():
         resp = batch_update_with_retries(doc_service, doc_id,
                                          {'requests': requests})
         if resp:
+            count("docs_updated")
+            count("bytes_written", len(text.encode()))
             print(f"Updated Doc {doc_id} for article '{article}'")
         else:
+            count("docs_skipped")
             print(f"Skipped Doc {doc_id} after retry attempts.")
 
 
-if __name__ == '__main__':
-    from credential import db_user, db_password
-
-    print("Fetching tickets & KB articles…")
-    fetch_ticket_kb_articles(db_user, db_password)
-
-    print("Clustering articles…")
-    cluster_articles("ticket_kb_articles.csv")
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fetch tickets, cluster them per KB article and update the article docs."
+    )
+    parser.add_argument("--input", default="ticket_kb_articles.csv",
+                        help="ticket CSV (on shared storage in shard mode)")
+    parser.add_argument("--fetch-only", action="store_true",
+                        help="only fetch tickets into --input (first step of a sharded run)")
+    parser.add_argument("--shards", type=int,
+                        help="number of article-ID shards for --shard-worker/--merge-shards; "
+                             "with --fetch-only, also split --input into per-shard files")
+    parser.add_argument("--shard-worker", action="store_true",
+                        help="cluster unclaimed shards of --input into --shard-folder, then exit")
+    parser.add_argument("--only-shard", type=int, nargs="+",
+                        help="with --shard-worker: restrict this worker to these shard numbers")
+    parser.add_argument("--stale-after", type=float,
+                        help="with --shard-worker: reclaim shard locks not touched for this many seconds")
+    parser.add_argument("--merge-shards", action="store_true",
+                        help="merge finished shards into the final dataset and update docs")
+    parser.add_argument("--shard-folder", default=SHARD_FOLDER)
+    args = parser.parse_args()
+    if (args.shard_worker or args.merge_shards) and not args.shards:
+        parser.error("--shards is required with --shard-worker/--merge-shards")
+    if args.stale_after is not None and args.stale_after <= 0:
+        parser.error("--stale-after must be positive")
+
+    if args.fetch_only:
+        from credential import db_user, db_password
+
+        with span("stage", stage="fetch"):
+            fetch_ticket_kb_articles(db_user, db_password, args.input)
+            if args.shards:
+                partition_tickets(args.input, args.shards, args.shard_folder)
+        print(summary(write_report(RUN_REPORT, prom_path=PROM_TEXTFILE)))
+        return
+
+    if args.shard_worker:
+        with span("stage", stage="cluster"):
+            _done, failed = run_shard_worker(args.input, args.shards, args.only_shard,
+                                             args.shard_folder, args.stale_after)
+        # workers may share a node, so every report file is per host and pid
+        worker = f"{gethostname()}-{os.getpid()}"
+        report = os.path.join(args.shard_folder, f"report-{worker}.json")
+        prom_path = None
+        if PROM_TEXTFILE:
+            root, ext = os.path.splitext(PROM_TEXTFILE)
+            prom_path = f"{root}-{worker}{ext}"
+        print(summary(write_report(report, prom_path=prom_path)))
+        # the other shards still ran, but the scheduler must see the worker as failed
+        if failed:
+            sys.exit(f"Shard(s) failed: {', '.join(map(str, failed))}")
+        return
+
+    if args.merge_shards:
+        print("Merging clustered shards…")
+        with span("stage", stage="merge"):
+            merge_shards(args.shards, args.shard_folder)
+    else:
+        from credential import db_user, db_password
+
+        print("Fetching tickets & KB articles…")
+        with span("stage", stage="fetch"):
+            fetch_ticket_kb_articles(db_user, db_password, args.input)
+
+        print("Clustering articles…")
+        with span("stage", stage="cluster"):
+            cluster_articles(args.input)
 
     print("Updating Google Docs from clusters…")
-    update_docs_from_clusters()
+    with span("stage", stage="update_docs"):
+        update_docs_from_clusters()
 
+    print(summary(write_report(RUN_REPORT, prom_path=PROM_TEXTFILE)))
     print("All done!")
+
+
+if __name__ == '__main__':
+    main()
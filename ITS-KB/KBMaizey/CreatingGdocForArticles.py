@@ -8,16 +8,25 @@ from bs4 import BeautifulSoup
 import re
 from socket import gethostname
 import os
+import sys
+import threading
 from googleapiclient.errors import HttpError
 import json
 import gspread
 from gspread_dataframe import get_as_dataframe, set_with_dataframe
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from instrumentation import api_execute, count, span, summary, write_report
+from metadata_cache import file_cache, invalidate_file, spreadsheet_id_cache
 
 
 # SCOPES for Google Docs and Google Drive
 SCOPES = ['https://www.googleapis.com/auth/drive', 'https://www.googleapis.com/auth/documents', 'https://www.googleapis.com/auth/spreadsheets']
 
+# Run report (JSON) and optional Prometheus textfile-collector output
+RUN_REPORT = os.environ.get("KB_RUN_REPORT", "gdoc_run_report.json")
+PROM_TEXTFILE = os.environ.get("KB_PROM_TEXTFILE")
+
 # Authenticate to Google API
 def authenticate():
     credentials = service_account.Credentials.from_service_account_file(
@@ -33,11 +42,11 @@ def create_google_doc(folder_id, title, content):
 
         # Create the Google Doc
         document = {'title': title}
-        doc = doc_service.documents().create(body=document).execute()
+        doc = api_execute("documents.create", doc_service.documents().create(body=document))
         document_id = doc.get('documentId')
 
         # Update the document content
-        doc_service.documents().batchUpdate(
+        api_execute("documents.batchUpdate", doc_service.documents().batchUpdate(
             documentId=document_id,
             body={
                 'requests': [{
@@ -47,15 +56,18 @@ def create_google_doc(folder_id, title, content):
                     }
                 }]
             }
-        ).execute()
+        ))
+        count("bytes_written", len(content.encode()))
 
         # Move the document to the shared drive folder
-        drive_service.files().update(
+        api_execute("files.update", drive_service.files().update(
             fileId=document_id,
             addParents=folder_id,
             fields='id, parents',
             supportsAllDrives=True  # Important for shared drives
-        ).execute()
+        ))
+        invalidate_file(document_id)
+        count("docs_created")
 
         print(f'Created document with ID: {document_id}')
         return document_id
@@ -74,7 +86,7 @@ def update_google_doc(doc_id, content,
     doc_service = build('docs', 'v1', credentials=creds)
 
     # 1) fetch & scan for marker
-    doc   = doc_service.documents().get(documentId=doc_id).execute()
+    doc   = api_execute("documents.get", doc_service.documents().get(documentId=doc_id))
     elems = doc.get('body', {}).get('content', [])
     marker_index = None
 
@@ -122,16 +134,39 @@ def update_google_doc(doc_id, content,
 
     # 3) send batchUpdate
     try:
-        doc_service.documents().batchUpdate(
+        api_execute("documents.batchUpdate", doc_service.documents().batchUpdate(
             documentId=doc_id,
             body={'requests': requests}
-        ).execute()
+        ))
+        count("bytes_written", len(content.encode()))
+        count("docs_updated")
         return True
     except HttpError as error:
         print(f"Error updating doc {doc_id}: {error}")
         return False
 
 
+def find_spreadsheet_id(creds, spreadsheet_title, folder_id):
+    # Drive folder search, done once per (folder, title) in a run
+    file_id = spreadsheet_id_cache.get((folder_id, spreadsheet_title))
+    if file_id:
+        return file_id
+    drive_service = build('drive', 'v3', credentials=creds)
+    query = f"'{folder_id}' in parents and name = '{spreadsheet_title}' and mimeType = 'application/vnd.google-apps.spreadsheet'"
+    results = api_execute("files.list", drive_service.files().list(
+        q=query,
+        spaces='drive',
+        fields='files(id, name)',
+        supportsAllDrives=True,
+        includeItemsFromAllDrives=True
+    ))
+    files = results.get('files', [])
+    if not files:
+        return None
+    spreadsheet_id_cache.put((folder_id, spreadsheet_title), files[0]['id'])
+    return files[0]['id']
+
+
 def load_tracking_dict_from_spreadsheet(spreadsheet_title, folder_id=None):
     try:
         # Authenticate and connect to Google Sheets
@@ -140,23 +175,10 @@ def load_tracking_dict_from_spreadsheet(spreadsheet_title, folder_id=None):
 
         # Search for the spreadsheet in the specified folder
         if folder_id:
-            drive_service = build('drive', 'v3', credentials=creds)
-            query = f"'{folder_id}' in parents and name = '{spreadsheet_title}' and mimeType = 'application/vnd.google-apps.spreadsheet'"
-            results = drive_service.files().list(
-    q=query,
-    spaces='drive',
-    fields='files(id, name)',
-    supportsAllDrives=True,
-    includeItemsFromAllDrives=True
-).execute()
-            files = results.get('files', [])
-
-            if not files:
+            file_id = find_spreadsheet_id(creds, spreadsheet_title, folder_id)
+            if not file_id:
                 print(f"Spreadsheet '{spreadsheet_title}' not found in folder ID {folder_id}.")
                 return {}
-
-            # Get the file ID of the spreadsheet
-            file_id = files[0]['id']
             spreadsheet = gc.open_by_key(file_id)
         else:
             # Open the spreadsheet by its title (assumes it's in "My Drive")
@@ -164,7 +186,9 @@ def load_tracking_dict_from_spreadsheet(spreadsheet_title, folder_id=None):
 
         # Load data from the spreadsheet into a DataFrame
         sheet = spreadsheet.sheet1
-        df = get_as_dataframe(sheet, dtype=str, na_values=[]).dropna(how='all')  # Clean empty rows
+        with span("sheets.read"):
+            df = get_as_dataframe(sheet, dtype=str, na_values=[]).dropna(how='all')  # Clean empty rows
+        count("api_calls", method="sheets.read")
         df.set_index('Article ID', inplace=True)
 
         # Convert the DataFrame to a dictionary
@@ -187,9 +211,10 @@ def save_tracking_dict_to_spreadsheet(spreadsheet_title, tracking_dict, folder_i
         gc = gspread.authorize(creds)
         drive_service = build('drive', 'v3', credentials=creds)
 
-        # Open or create the spreadsheet
+        # Open or create the spreadsheet (by ID if we located it earlier this run)
+        known_id = spreadsheet_id_cache.get((folder_id, spreadsheet_title)) if folder_id else None
         try:
-            spreadsheet = gc.open(spreadsheet_title)
+            spreadsheet = gc.open_by_key(known_id) if known_id else gc.open(spreadsheet_title)
             sheet = spreadsheet.sheet1
         except gspread.exceptions.SpreadsheetNotFound:
             # Create the spreadsheet if it doesn't exist
@@ -199,27 +224,32 @@ def save_tracking_dict_to_spreadsheet(spreadsheet_title, tracking_dict, folder_i
         # Move the spreadsheet to the folder if folder_id is provided
         if folder_id:
             # Get current parents
-            file = drive_service.files().get(
-                fileId=spreadsheet.id,
-                fields='parents',
-                supportsAllDrives=True
-            ).execute()
+            file = file_cache.get_or_load(spreadsheet.id, lambda: api_execute(
+                "files.get", drive_service.files().get(
+                    fileId=spreadsheet.id,
+                    fields='parents, trashed',
+                    supportsAllDrives=True
+                )))
             current_parents = file.get('parents', [])
             previous_parents = ",".join(current_parents)
 
             # Move the file only if it's not already in the desired folder
             if folder_id not in current_parents:
-                drive_service.files().update(
+                api_execute("files.update", drive_service.files().update(
                     fileId=spreadsheet.id,
                     addParents=folder_id,
                     removeParents=previous_parents,
                     fields='id, parents',
                     supportsAllDrives=True
-                ).execute()
+                ))
+                invalidate_file(spreadsheet.id)
+            spreadsheet_id_cache.put((folder_id, spreadsheet_title), spreadsheet.id)
 
         # Write the DataFrame to the spreadsheet
-        sheet.clear()
-        set_with_dataframe(sheet, df)
+        with span("sheets.write"):
+            sheet.clear()
+            set_with_dataframe(sheet, df)
+        count("api_calls", method="sheets.write")
         print(f"Tracking dictionary saved to spreadsheet: {spreadsheet_title}")
         print(f"Spreadsheet id: {spreadsheet.id}")
     except Exception as e:
@@ -227,14 +257,20 @@ def save_tracking_dict_to_spreadsheet(spreadsheet_title, tracking_dict, folder_i
 
 def document_exists(doc_id, folder_id):
     try:
-        creds = authenticate()
-        drive_service = build('drive', 'v3', credentials=creds)
-        # Get the file's parents (folders) and trashed status
-        file_metadata = drive_service.files().get(
-            fileId=doc_id,
-            fields='parents, trashed',
-            supportsAllDrives=True
-        ).execute()
+        # Reuse this run's answer for the same doc; None records a 404
+        file_metadata = file_cache.get(doc_id, False)
+        if file_metadata is False:
+            creds = authenticate()
+            drive_service = build('drive', 'v3', credentials=creds)
+            # Get the file's parents (folders) and trashed status
+            file_metadata = api_execute("files.get", drive_service.files().get(
+                fileId=doc_id,
+                fields='parents, trashed',
+                supportsAllDrives=True
+            ))
+            file_cache.put(doc_id, file_metadata)
+        if file_metadata is None:
+            return False
         if file_metadata.get('trashed'):
             return False
         parents = file_metadata.get('parents', [])
@@ -244,6 +280,7 @@ def document_exists(doc_id, folder_id):
             return False
     except HttpError as error:
         if error.resp.status == 404:
+            file_cache.put(doc_id, None)
             return False
         else:
             print(f"An error occurred while checking if document exists: {error}")
@@ -256,10 +293,12 @@ def create_docs_for_rows(
     results,               # list of rows from Denodo
     tracking_dict,         # loaded from sheet
     spreadsheet_title,     # e.g. "Public Tracking"
-    spreadsheet_folder_id  # same as folder_id for the sheet
+    spreadsheet_folder_id, # same as folder_id for the sheet
+    current_ids=None       # all live article IDs, when `results` holds only changed rows
 ):
     # 1) Figure out which IDs we no longer have — delete their docs & drop them.
-    current_ids = {str(row[0]) for row in results}
+    if current_ids is None:
+        current_ids = {str(row[0]) for row in results}
     to_delete = set(tracking_dict) - current_ids
     for aid in to_delete:
         delete_google_doc(tracking_dict[aid]['doc_id'])
@@ -287,6 +326,8 @@ def create_docs_for_rows(
         if needs:
             rows_to_process.append(row)
 
+    count("articles_to_process", len(rows_to_process), sheet=spreadsheet_title)
+
     # 3) Process only those rows
     for aid, title, body, summary, rev, url in rows_to_process:
         aid_str = str(aid)
@@ -323,10 +364,12 @@ def delete_google_doc(doc_id):
         creds = authenticate()
         drive_service = build('drive', 'v3', credentials=creds)
 
-        drive_service.files().delete(
+        api_execute("files.delete", drive_service.files().delete(
             fileId=doc_id,
             supportsAllDrives=True
-        ).execute()
+        ))
+        invalidate_file(doc_id)
+        count("docs_deleted")
 
         return True
     except HttpError as error:
@@ -335,18 +378,32 @@ def delete_google_doc(doc_id):
 
 
 # Denodo Database connection and query execution
-def denodo_database(driver_path, credential_user_id, credential_password, server_name, jdbc_port, server_database, query):
-    conn_uri = f"jdbc:denodo://{server_name}:{jdbc_port}/{server_database}?userAgent={dbdriver.__name__}-{gethostname()}"
-    cnxn = dbdriver.connect(
-        "com.denodo.vdp.jdbc.Driver",
-        conn_uri,
-        driver_args={"useKerberos": "true", "user": credential_user_id, "password": credential_password, "ssl": "true"},
-        jars=driver_path
-    )
+# jaydebeapi starts the JVM on first connect without any locking, so concurrent
+# first connects from the audience threads would race; serialize connecting.
+_connect_lock = threading.Lock()
 
+def denodo_connect(driver_path, credential_user_id, credential_password, server_name, jdbc_port, server_database):
+    conn_uri = f"jdbc:denodo://{server_name}:{jdbc_port}/{server_database}?userAgent={dbdriver.__name__}-{gethostname()}"
+    with _connect_lock:
+        return dbdriver.connect(
+            "com.denodo.vdp.jdbc.Driver",
+            conn_uri,
+            driver_args={"useKerberos": "true", "user": credential_user_id, "password": credential_password, "ssl": "true"},
+            jars=driver_path
+        )
+
+def denodo_query(cnxn, query, params=None):
     cur = cnxn.cursor()
-    cur.execute(query)
-    results = cur.fetchall()
+    with span("denodo.query"):
+        cur.execute(query, params)
+        results = cur.fetchall()
+    cur.close()
+    count("rows_fetched", len(results))
+    return results
+
+def denodo_database(driver_path, credential_user_id, credential_password, server_name, jdbc_port, server_database, query, params=None):
+    cnxn = denodo_connect(driver_path, credential_user_id, credential_password, server_name, jdbc_port, server_database)
+    results = denodo_query(cnxn, query, params)
     cnxn.close()
     return results
 
@@ -360,47 +417,92 @@ def creating_dataframe(results):
 
 # Clean HTML from text
 def clean_html(html):
-    soup = BeautifulSoup(html, 'html.parser')
-    return soup.get_text(separator=' ', strip=True)
+    with span("html.clean"):
+        soup = BeautifulSoup(html, 'html.parser')
+        return soup.get_text(separator=' ', strip=True)
 
 # Print the results (for debugging)
 def print_results(results):
     print(results)
 
 
-def main():
-    spreadsheet_folder_id = '0AIl6WpKmR6tsUk9PVA'
-    spreadsheet_title_public = "Public Tracking"
-    spreadsheet_title_um_login = "UM-Login Tracking"
-    spreadsheet_title_support_staff = "Support Staff Tracking"
-
-    # Load tracking dictionaries from Google Spreadsheets
-    tracking_dict_for_public = load_tracking_dict_from_spreadsheet("Public Tracking", spreadsheet_folder_id)
-    tracking_dict_for_um_login = load_tracking_dict_from_spreadsheet("UM-Login Tracking", spreadsheet_folder_id)
-    tracking_dict_for_support_staff = load_tracking_dict_from_spreadsheet("Support Staff Tracking", spreadsheet_folder_id)
-
-    # Set the folder ID where the documents will be created in Google Drive
-
-    folder_id_public = "10EeZLQcNr9QIpH-IxcV9J_I8VKv-eiG9"  # Replace with your actual folder ID
-    folder_id_um_login = "1dFJYWD-fQi5NBekIwVtqlKlYUQQMRKOm"  # Replace with your actual folder ID
-    folder_id_support_staff = "1XPj8BzKWm5IKxeaizH5lOfTwAYNT5Bpt" 
-    
-    query_public = """
-    SELECT articleid, articlesubject, articlebody, articlesummary, revisionnumber
-    FROM dw_tdx.knowledgebasearticlesreportview 
-    WHERE articlestatusid = 3 AND ispublic = 1 AND clientappid = 30 ORDER BY articleid;
+# Article sets to sync: (tracking spreadsheet, docs folder, view filter)
+AUDIENCES = [
+    ("Public Tracking", "10EeZLQcNr9QIpH-IxcV9J_I8VKv-eiG9",
+     "ispublic = 1 ORDER BY articleid"),
+    ("UM-Login Tracking", "1dFJYWD-fQi5NBekIwVtqlKlYUQQMRKOm",
+     "ispublic = 0 AND categorypathnames = 'U-M Login' ORDER BY articleid limit 10"),
+    ("Support Staff Tracking", "1XPj8BzKWm5IKxeaizH5lOfTwAYNT5Bpt",
+     "ispublic = 0 AND categorypathnames <> 'U-M Login' ORDER BY articleid"),
+]
+
+# Phase 1 only needs ids and revisions; phase 2 pulls bodies for the changed ids
+REVISION_QUERY = """
+SELECT articleid, revisionnumber
+FROM dw_tdx.knowledgebasearticlesreportview
+WHERE articlestatusid = 3 AND clientappid = 30 AND {audience}
+"""
+BODY_QUERY = """
+SELECT articleid, articlesubject, articlebody, articlesummary, revisionnumber
+FROM dw_tdx.knowledgebasearticlesreportview
+WHERE articlestatusid = 3 AND clientappid = 30 AND articleid IN ({placeholders})
+ORDER BY articleid
+"""
+BODY_QUERY_BATCH = 500
+
+
+def articles_needing_content(revisions, tracking_dict, folder_id):
     """
-    query_um_login = """
-    SELECT articleid, articlesubject, articlebody, articlesummary, revisionnumber
-    FROM dw_tdx.knowledgebasearticlesreportview 
-    WHERE articlestatusid = 3 AND ispublic = 0 AND clientappid = 30 AND categorypathnames = 'U-M Login' ORDER BY articleid limit 10;
+    Diffs (articleid, revisionnumber) pairs against the tracking dict and
+    returns the ids whose doc must be (re)written: new articles, bumped
+    revisions, and tracked docs that were moved or trashed.
     """
-    query_support_staff = """
-    SELECT articleid, articlesubject, articlebody, articlesummary, revisionnumber
-    FROM dw_tdx.knowledgebasearticlesreportview 
-    WHERE articlestatusid = 3 AND ispublic = 0 AND clientappid = 30 AND categorypathnames <> 'U-M Login' ORDER BY articleid;
-    """
-    
+    needed = []
+    for aid, rev in revisions:
+        entry = tracking_dict.get(str(aid))
+        if entry is None or str(entry['revision_number']) != str(rev):
+            needed.append(aid)
+        elif not document_exists(entry['doc_id'], folder_id):
+            needed.append(aid)
+    return needed
+
+
+def fetch_article_bodies(cnxn, article_ids):
+    """Fetches full rows for `article_ids` in IN-list batches using bind parameters."""
+    results = []
+    for i in range(0, len(article_ids), BODY_QUERY_BATCH):
+        batch = article_ids[i:i + BODY_QUERY_BATCH]
+        query = BODY_QUERY.format(placeholders=", ".join("?" for _ in batch))
+        results.extend(denodo_query(cnxn, query, batch))
+    return results
+
+
+def sync_audience(connect_args, spreadsheet_title, folder_id, audience, spreadsheet_folder_id):
+    tracking_dict = load_tracking_dict_from_spreadsheet(spreadsheet_title, spreadsheet_folder_id)
+
+    cnxn = denodo_connect(*connect_args)
+    try:
+        revisions = denodo_query(cnxn, REVISION_QUERY.format(audience=audience))
+        with span("sync.diff", sheet=spreadsheet_title):
+            changed = articles_needing_content(revisions, tracking_dict, folder_id)
+        print(f"{spreadsheet_title}: {len(changed)} of {len(revisions)} articles new or changed")
+        count("articles_changed", len(changed), sheet=spreadsheet_title)
+        count("articles_unchanged", len(revisions) - len(changed), sheet=spreadsheet_title)
+        results = fetch_article_bodies(cnxn, changed)
+    finally:
+        cnxn.close()
+
+    df_results = creating_dataframe(results)
+    print_results(df_results)
+
+    create_docs_for_rows(folder_id, df_results.values.tolist(), tracking_dict,
+                         spreadsheet_title, spreadsheet_folder_id,
+                         current_ids={str(aid) for aid, _rev in revisions})
+
+
+def main():
+    spreadsheet_folder_id = '0AIl6WpKmR6tsUk9PVA'
+
     # Denodo connection details (make sure these are correctly defined in credential.py)
     credential_password = credential.db_password
     credential_user_id = credential.db_user
@@ -408,28 +510,29 @@ def main():
     denodoserver_name = "denodo.it.umich.edu"
     denodoserver_jdbc_port = "9999"
     denodoserver_database = "gateway"
-
-    # Fetch data from the Denodo database
-    results_public = denodo_database(denododriver_path, credential_user_id, credential_password, 
-                             denodoserver_name, denodoserver_jdbc_port, denodoserver_database, query_public)
-    results_um_login = denodo_database(denododriver_path, credential_user_id, credential_password,
-                               denodoserver_name, denodoserver_jdbc_port, denodoserver_database, query_um_login)
-    results_support_staff = denodo_database(denododriver_path, credential_user_id, credential_password,
-                                denodoserver_name, denodoserver_jdbc_port, denodoserver_database, query_support_staff)
-    
-    # Convert the results to a DataFrame
-    df_results_public = creating_dataframe(results_public)
-    print_results(df_results_public)
-    df_results_um_login = creating_dataframe(results_um_login)
-    print_results(df_results_um_login)
-    df_results_support_staff = creating_dataframe(results_support_staff)
-    print_results(df_results_support_staff)
-
-    # Create documents and update tracking dictionaries
-    create_docs_for_rows(folder_id_public, df_results_public.values.tolist(), tracking_dict_for_public, spreadsheet_title_public,spreadsheet_folder_id )
-    create_docs_for_rows(folder_id_um_login, df_results_um_login.values.tolist(), tracking_dict_for_um_login, spreadsheet_title_um_login,spreadsheet_folder_id)
-    create_docs_for_rows(folder_id_support_staff, df_results_support_staff.values.tolist(), tracking_dict_for_support_staff, spreadsheet_title_support_staff,spreadsheet_folder_id)
-    
+    connect_args = (denododriver_path, credential_user_id, credential_password,
+                    denodoserver_name, denodoserver_jdbc_port, denodoserver_database)
+
+    # The three audiences are independent, so sync them side by side
+    with ThreadPoolExecutor(max_workers=len(AUDIENCES)) as pool:
+        futures = {
+            pool.submit(sync_audience, connect_args, title, folder_id, audience,
+                        spreadsheet_folder_id): title
+            for title, folder_id, audience in AUDIENCES
+        }
+        failed = []
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Sync failed for {futures[future]}: {e}")
+                count("sync_failures", sheet=futures[future])
+                failed.append(futures[future])
+
+    print(summary(write_report(RUN_REPORT, prom_path=PROM_TEXTFILE)))
+    # the other audiences still ran, but the scheduler must see the run as failed
+    if failed:
+        sys.exit(f"Sync failed for: {', '.join(sorted(failed))}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,604 @@
+"""
+Offline benchmark for the KB pipeline.
+
+Drives fetch_ticket_kb_articles, cluster_articles, create_docs_for_rows,
+sync_audience and update_docs_from_clusters against in-process fakes (Denodo
+cursor, Google discovery client, gspread, sentence encoder) on synthetic ticket
+corpora and reports wall time, API call counts and peak memory per stage.
+
+    python benchmark_pipeline.py --sizes 1000 5000 20000 --latency 0.002 --rate-limit-every 50
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import types
+from collections import Counter
+from contextlib import contextmanager
+
+import httplib2
+import numpy as np
+import pandas as pd
+from googleapiclient.errors import HttpError
+
+import ClusterTicketsAndUpdateArticles as ctua
+import CreatingGdocForArticles as cgfa
+import instrumentation
+import metadata_cache
+
+_real_sleep = time.sleep
+
+WORDS = (
+    "password reset duo vpn wifi eduroam printer canvas email outlook "
+    "account locked mfa token laptop install license zoom drive share "
+    "permission access error login browser cache update mobile phone"
+).split()
+
+
+# ====== SYNTHETIC DATA ======
+
+def make_ticket_rows(n_tickets, n_articles, seed=0):
+    """Rows shaped like the ticketsview QUERY result, Zipf-distributed over articles."""
+    rng = random.Random(seed)
+    weights = [1.0 / (i + 1) for i in range(n_articles)]
+    article_ids = rng.choices(range(n_articles), weights=weights, k=n_tickets)
+    rows = []
+    for tid, a in enumerate(article_ids, start=100000):
+        title = " ".join(rng.choices(WORDS, k=rng.randint(3, 8)))
+        body = " ".join(rng.choices(WORDS, k=rng.randint(20, 80)))
+        description = f"<div><p>{body}</p><br/><span>ticket {tid}</span></div>"
+        rows.append((tid, title, description, f"KB Article {a}", 5000 + a))
+    return rows
+
+
+def make_article_rows(n_articles, seed=0):
+    """Rows shaped like the knowledgebasearticlesreportview query result."""
+    rng = random.Random(seed)
+    rows = []
+    for a in range(n_articles):
+        aid = 5000 + a
+        body = " ".join(rng.choices(WORDS, k=rng.randint(100, 400)))
+        rows.append((
+            aid,
+            f"KB Article {a}",
+            body,
+            " ".join(rng.choices(WORDS, k=12)),
+            rng.randint(1, 5),
+            f"https://teamdynamix.umich.edu/TDClient/30/Portal/KB/ArticleDet?ID={aid}",
+        ))
+    return rows
+
+
+# ====== FAKE DENODO (DB-API) ======
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self._rows = []
+        self._pos = 0
+
+    def execute(self, sql, params=None):
+        self.conn.queries.append((sql, params))
+        rows = self.conn.rows
+        self._rows = rows(sql, params) if callable(rows) else rows
+        self._pos = 0
+        self.description = [(f"col{i}",) for i in range(len(self._rows[0]) if self._rows else 0)]
+        _real_sleep(self.conn.latency)
+
+    def fetchmany(self, size=1):
+        chunk = self._rows[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        self.conn.rows_fetched += len(chunk)
+        _real_sleep(self.conn.latency_per_row * len(chunk))
+        return chunk
+
+    def fetchall(self):
+        return self.fetchmany(len(self._rows) - self._pos)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """`rows` is a fixed result set or a callable (sql, params) -> rows."""
+
+    def __init__(self, rows, latency=0.0, latency_per_row=0.0):
+        self.rows = rows
+        self.latency = latency
+        self.latency_per_row = latency_per_row
+        self.queries = []
+        self.rows_fetched = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        pass
+
+
+def fake_dbdriver(conn):
+    return types.SimpleNamespace(__name__="jaydebeapi", connect=lambda *a, **kw: conn)
+
+
+# ====== FAKE GOOGLE APIS ======
+
+class _FakeRequest:
+    def __init__(self, backend, method, fn):
+        self.backend = backend
+        self.method = method
+        self.fn = fn
+
+    def execute(self):
+        return self.backend.call(self.method, self.fn)
+
+
+class FakeGoogleBackend:
+    """
+    Shared state behind the fake Drive/Docs services. Every execute() is
+    counted by method; methods listed in `throttle_methods` answer every
+    `rate_limit_every`-th call with HTTP 429.
+    """
+
+    def __init__(self, latency=0.0, rate_limit_every=0,
+                 throttle_methods=("documents.batchUpdate",)):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.throttle_methods = set(throttle_methods)
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.docs = {}
+        self.files = {}
+        self.spreadsheets = {}
+        self._next_id = 0
+
+    def new_id(self, prefix):
+        self._next_id += 1
+        return f"{prefix}{self._next_id:08d}"
+
+    def call(self, method, fn):
+        self.calls[method] += 1
+        _real_sleep(self.latency)
+        if (self.rate_limit_every and method in self.throttle_methods
+                and self.calls[method] % self.rate_limit_every == 0):
+            self.throttled[method] += 1
+            resp = httplib2.Response({"status": 429, "reason": "Too Many Requests"})
+            raise HttpError(resp, b'{"error": {"code": 429}}')
+        return fn()
+
+    def not_found(self):
+        resp = httplib2.Response({"status": 404, "reason": "Not Found"})
+        return HttpError(resp, b'{"error": {"code": 404}}')
+
+    # -- docs --
+
+    def add_doc(self, text, parents):
+        doc_id = self.new_id("doc")
+        self.docs[doc_id] = text if text.endswith("\n") else text + "\n"
+        self.files[doc_id] = {"parents": list(parents), "trashed": False}
+        return doc_id
+
+    def doc_structure(self, doc_id):
+        if doc_id not in self.docs:
+            raise self.not_found()
+        content = [{"endIndex": 1, "sectionBreak": {}}]
+        idx = 1
+        for line in self.docs[doc_id].splitlines(keepends=True):
+            end = idx + len(line)
+            content.append({
+                "startIndex": idx,
+                "endIndex": end,
+                "paragraph": {"elements": [{
+                    "startIndex": idx,
+                    "endIndex": end,
+                    "textRun": {"content": line},
+                }]},
+            })
+            idx = end
+        return {"documentId": doc_id, "body": {"content": content}}
+
+    def apply_requests(self, doc_id, requests):
+        if doc_id not in self.docs:
+            raise self.not_found()
+        text = self.docs[doc_id]
+        for req in requests:
+            if "deleteContentRange" in req:
+                r = req["deleteContentRange"]["range"]
+                text = text[:r["startIndex"] - 1] + text[r["endIndex"] - 1:]
+            elif "insertText" in req:
+                i = req["insertText"]["location"]["index"] - 1
+                text = text[:i] + req["insertText"]["text"] + text[i:]
+        self.docs[doc_id] = text if text.endswith("\n") else text + "\n"
+        return {"documentId": doc_id, "replies": [{} for _ in requests]}
+
+
+class _FakeDocuments:
+    def __init__(self, backend):
+        self.b = backend
+
+    def get(self, documentId):
+        return _FakeRequest(self.b, "documents.get",
+                            lambda: self.b.doc_structure(documentId))
+
+    def create(self, body):
+        return _FakeRequest(self.b, "documents.create",
+                            lambda: {"documentId": self.b.add_doc("", [])})
+
+    def batchUpdate(self, documentId, body):
+        return _FakeRequest(self.b, "documents.batchUpdate",
+                            lambda: self.b.apply_requests(documentId, body["requests"]))
+
+
+class _FakeFiles:
+    def __init__(self, backend):
+        self.b = backend
+
+    def _get(self, fileId):
+        if fileId not in self.b.files:
+            raise self.b.not_found()
+        return dict(self.b.files[fileId])
+
+    def _update(self, fileId, addParents=None, removeParents=None):
+        meta = self.b.files.setdefault(fileId, {"parents": [], "trashed": False})
+        if removeParents:
+            meta["parents"] = [p for p in meta["parents"] if p not in removeParents.split(",")]
+        if addParents:
+            meta["parents"].append(addParents)
+        return {"id": fileId, "parents": meta["parents"]}
+
+    def _delete(self, fileId):
+        if fileId not in self.b.files:
+            raise self.b.not_found()
+        self.b.files.pop(fileId)
+        self.b.docs.pop(fileId, None)
+        return {}
+
+    def _list(self, q):
+        files = [{"id": sid, "name": title}
+                 for title, sid in self.b.spreadsheets.items()
+                 if f"name = '{title}'" in q]
+        return {"files": files}
+
+    def get(self, fileId, fields=None, supportsAllDrives=False):
+        return _FakeRequest(self.b, "files.get", lambda: self._get(fileId))
+
+    def update(self, fileId, addParents=None, removeParents=None,
+               fields=None, supportsAllDrives=False):
+        return _FakeRequest(self.b, "files.update",
+                            lambda: self._update(fileId, addParents, removeParents))
+
+    def delete(self, fileId, supportsAllDrives=False):
+        return _FakeRequest(self.b, "files.delete", lambda: self._delete(fileId))
+
+    def list(self, q=None, **kwargs):
+        return _FakeRequest(self.b, "files.list", lambda: self._list(q or ""))
+
+
+class FakeService:
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def documents(self):
+        return _FakeDocuments(self.backend)
+
+    def files(self):
+        return _FakeFiles(self.backend)
+
+
+def fake_build(backend):
+    def build(service_name, version, credentials=None, **kwargs):
+        backend.calls[f"build.{service_name}"] += 1
+        return FakeService(backend, service_name)
+    return build
+
+
+# ====== FAKE GSPREAD ======
+
+class FakeWorksheet:
+    def __init__(self):
+        self.df = pd.DataFrame()
+
+    def clear(self):
+        self.df = pd.DataFrame()
+
+
+class FakeSpreadsheet:
+    def __init__(self, sid):
+        self.id = sid
+        self.sheet1 = FakeWorksheet()
+
+
+class FakeGspreadClient:
+    def __init__(self, backend, sheets):
+        self.backend = backend
+        self.sheets = sheets
+
+    def _by_title(self, title):
+        if title not in self.backend.spreadsheets:
+            raise ctua.gspread.exceptions.SpreadsheetNotFound(title)
+        return self.sheets[self.backend.spreadsheets[title]]
+
+    def open(self, title):
+        self.backend.calls["sheets.open"] += 1
+        return self._by_title(title)
+
+    def open_by_key(self, key):
+        self.backend.calls["sheets.open_by_key"] += 1
+        return self.sheets[key]
+
+    def create(self, title):
+        self.backend.calls["sheets.create"] += 1
+        sid = self.backend.new_id("sheet")
+        self.backend.spreadsheets[title] = sid
+        # gspread creates new spreadsheets in the service account's root
+        self.backend.files[sid] = {"parents": ["root"], "trashed": False}
+        self.sheets[sid] = FakeSpreadsheet(sid)
+        return self.sheets[sid]
+
+
+def fake_gspread(backend, sheets):
+    return types.SimpleNamespace(
+        authorize=lambda creds: FakeGspreadClient(backend, sheets),
+        exceptions=ctua.gspread.exceptions,
+    )
+
+
+def fake_get_as_dataframe(backend):
+    def get_as_dataframe(sheet, dtype=None, na_values=None):
+        backend.calls["sheets.read"] += 1
+        return sheet.df.astype(str) if dtype is str else sheet.df.copy()
+    return get_as_dataframe
+
+
+def fake_set_with_dataframe(backend):
+    def set_with_dataframe(sheet, df):
+        backend.calls["sheets.write"] += 1
+        sheet.df = df.copy()
+    return set_with_dataframe
+
+
+def seed_tracking_sheet(backend, sheets, title, tracking_dict, folder_id="folder-sheets"):
+    sid = backend.new_id("sheet")
+    backend.spreadsheets[title] = sid
+    backend.files[sid] = {"parents": [folder_id], "trashed": False}
+    sheets[sid] = FakeSpreadsheet(sid)
+    df = pd.DataFrame.from_dict(tracking_dict, orient="index").reset_index()
+    sheets[sid].sheet1.df = df.rename(columns={"index": "Article ID"})
+
+
+# ====== FAKE ENCODER ======
+
+class FakeSentenceTransformer:
+    """Deterministic hashed bag-of-words encoder standing in for MiniLM."""
+
+    dim = 384
+
+    def __init__(self, name=None):
+        self.name = name
+
+    def encode(self, texts, show_progress_bar=False, **kwargs):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for tok in str(text).lower().split():
+                h = int.from_bytes(hashlib.md5(tok.encode()).digest()[:4], "little")
+                out[i, h % self.dim] += 1.0
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return out / np.where(norms == 0, 1, norms)
+
+
+# ====== HARNESS ======
+
+@contextmanager
+def patched(obj, **attrs):
+    saved = {k: getattr(obj, k) for k in attrs}
+    for k, v in attrs.items():
+        setattr(obj, k, v)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            setattr(obj, k, v)
+
+
+@contextmanager
+def fake_environment(backend, sheets):
+    """Point both pipeline modules at the fake Google/Sheets/encoder stack."""
+    common = dict(
+        build=fake_build(backend),
+        authenticate=lambda: None,
+        gspread=fake_gspread(backend, sheets),
+        get_as_dataframe=fake_get_as_dataframe(backend),
+        set_with_dataframe=fake_set_with_dataframe(backend),
+    )
+    with patched(ctua, SentenceTransformer=FakeSentenceTransformer, **common), \
+            patched(cgfa, **common), \
+            patched(ctua.time, sleep=lambda s: backend.calls.update({"backoff.sleep": 1})):
+        yield
+
+
+def seed_tracked_docs(backend, article_rows, folder_id):
+    """
+    Tracks the first half of `article_rows`, half of those at an old revision.
+    Of the up-to-date ones, every third doc was moved out of the folder and
+    every fifth trashed, so their existence is checked as well as their revision.
+    """
+    tracking = {}
+    for i, (aid, title, body, summary, rev, url) in enumerate(article_rows[: len(article_rows) // 2]):
+        doc_id = backend.add_doc(f"{url}\n\nTitle: {title}\n", [folder_id])
+        stale = int(aid) % 2 == 0
+        if not stale and i % 3 == 0:
+            backend.files[doc_id]["parents"] = ["folder-elsewhere"]
+        elif not stale and i % 5 == 0:
+            backend.files[doc_id]["trashed"] = True
+        tracking[str(aid)] = {"doc_id": doc_id,
+                              "revision_number": str(rev - 1 if stale else rev)}
+    return tracking
+
+
+def article_queries(article_rows):
+    """Answers REVISION_QUERY and the BODY_QUERY IN-list batches like the report view."""
+    by_id = {row[0]: row[:5] for row in article_rows}
+
+    def rows(sql, params):
+        if "articleid IN" in sql:
+            return [by_id[aid] for aid in params if aid in by_id]
+        return [(row[0], row[4]) for row in article_rows]
+    return rows
+
+
+# Calls each stage must have made; the pipeline prints and swallows most API
+# errors, so a stage that silently skipped its writes would otherwise still report
+REQUIRED_CALLS = {
+    "create_docs_for_rows": ("documents.create", "sheets.write"),
+    "sync_audience": ("documents.create", "sheets.read", "sheets.write"),
+    "update_docs_from_clusters": ("sheets.read", "documents.batchUpdate"),
+}
+
+
+def check_required_calls(result):
+    missing = [m for m in REQUIRED_CALLS.get(result["stage"], ())
+               if result["api_calls"].get(m, 0) < 1]
+    if missing:
+        raise RuntimeError(f"{result['stage']} made no {', '.join(missing)} call; "
+                           "check the output above for a swallowed error")
+
+
+def measure(name, fn, backend=None):
+    before = Counter(backend.calls) if backend else Counter()
+    instrumentation.reset()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    fn()
+    wall = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    calls = dict(Counter(backend.calls) - before) if backend else {}
+    result = {
+        "stage": name,
+        "wall_s": round(wall, 4),
+        "peak_mb": round(peak / 2**20, 2),
+        "api_calls": calls,
+        "spans": {s["name"]: s["total_s"] for s in instrumentation.report()["spans"]
+                  if not s["labels"]},
+        "cache_hits": {c["labels"]["cache"]: c["value"] for c in instrumentation.report()["counters"]
+                       if c["name"] == "cache_hits"},
+    }
+    check_required_calls(result)
+    return result
+
+
+def run_benchmark(n_tickets, latency=0.0, db_latency_per_row=0.0, rate_limit_every=0, seed=0):
+    n_articles = max(10, n_tickets // 50)
+    metadata_cache.clear_all()  # each benchmark is its own run
+    backend = FakeGoogleBackend(latency=latency, rate_limit_every=rate_limit_every)
+    sheets = {}
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp, fake_environment(backend, sheets):
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            conn = FakeConnection(make_ticket_rows(n_tickets, n_articles, seed),
+                                  latency_per_row=db_latency_per_row)
+            with patched(ctua, dbdriver=fake_dbdriver(conn)):
+                results.append(measure(
+                    "fetch_ticket_kb_articles",
+                    lambda: ctua.fetch_ticket_kb_articles("user", "pw"),
+                ))
+            results[-1]["api_calls"] = {"db.execute": len(conn.queries)}
+
+            results.append(measure(
+                "cluster_articles",
+                lambda: ctua.cluster_articles("ticket_kb_articles.csv"),
+            ))
+
+            # All bodies handed over up front, as main() did before the two-phase
+            # sync; document_exists() is asked twice about the up-to-date docs
+            article_rows = make_article_rows(n_articles, seed)
+            folder_id = "folder-public"
+            tracking = seed_tracked_docs(backend, article_rows, folder_id)
+            results.append(measure(
+                "create_docs_for_rows",
+                lambda: cgfa.create_docs_for_rows(folder_id, article_rows, dict(tracking),
+                                                  "Public Tracking", "folder-sheets"),
+                backend,
+            ))
+
+            # Same starting state through the production path: revisions first,
+            # then bodies only for the new, changed, moved or trashed articles
+            sync_folder = "folder-sync"
+            seed_tracking_sheet(backend, sheets, "Sync Tracking",
+                                seed_tracked_docs(backend, article_rows, sync_folder))
+            article_conn = FakeConnection(article_queries(article_rows),
+                                          latency_per_row=db_latency_per_row)
+            with patched(cgfa, dbdriver=fake_dbdriver(article_conn)):
+                results.append(measure(
+                    "sync_audience",
+                    lambda: cgfa.sync_audience(("driver.jar", "user", "pw", "host", "9999", "db"),
+                                               "Sync Tracking", sync_folder, "ispublic = 1",
+                                               "folder-sheets"),
+                    backend,
+                ))
+            results[-1]["api_calls"].update({"db.execute": len(article_conn.queries),
+                                             "db.rows": article_conn.rows_fetched})
+
+            um_tracking = {str(5000 + a): {"doc_id": backend.add_doc(f"KB Article {a}\n", ["folder-um"]),
+                                           "revision_number": "1"}
+                           for a in range(n_articles)}
+            seed_tracking_sheet(backend, sheets, "UM-Login Tracking", um_tracking)
+            results.append(measure("update_docs_from_clusters",
+                                   ctua.update_docs_from_clusters, backend))
+        finally:
+            os.chdir(cwd)
+
+    return {
+        "n_tickets": n_tickets,
+        "n_articles": n_articles,
+        "throttled": dict(backend.throttled),
+        "stages": results,
+    }
+
+
+def print_report(report):
+    print(f"\n== {report['n_tickets']} tickets / {report['n_articles']} articles ==")
+    print(f"{'stage':<28}{'wall (s)':>10}{'peak (MB)':>11}  api calls")
+    for r in report["stages"]:
+        calls = ", ".join(f"{k}={v}" for k, v in sorted(r["api_calls"].items()))
+        hits = ", ".join(f"{k}={v}" for k, v in sorted(r["cache_hits"].items()))
+        print(f"{r['stage']:<28}{r['wall_s']:>10.3f}{r['peak_mb']:>11.1f}  {calls}"
+              + (f"  (cache hits: {hits})" if hits else ""))
+    if report["throttled"]:
+        print(f"429s injected: {report['throttled']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every fake Google API call")
+    parser.add_argument("--db-latency-per-row", type=float, default=0.0)
+    parser.add_argument("--rate-limit-every", type=int, default=0,
+                        help="answer every Nth docs batchUpdate with HTTP 429")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the reports to this file")
+    args = parser.parse_args()
+
+    reports = []
+    for size in args.sizes:
+        report = run_benchmark(size, args.latency, args.db_latency_per_row,
+                               args.rate_limit_every, args.seed)
+        print_report(report)
+        reports.append(report)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
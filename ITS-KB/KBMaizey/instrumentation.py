@@ -0,0 +1,154 @@
+"""
+Lightweight run instrumentation: timed spans, labelled counters and a
+machine-readable run report (JSON, optionally Prometheus textfile format).
+
+All state is process-global so the pipeline functions can record without
+threading a recorder through every call:
+
+    with span("denodo.query"):
+        cur.execute(QUERY)
+    count("rows_fetched", len(rows))
+    resp = api_execute("documents.get", doc_service.documents().get(documentId=doc_id))
+    write_report("run_report.json", prom_path="kb_pipeline.prom")
+
+KBMaizey/ and MiniProject-DataClustering/ each carry an identical copy so
+either folder runs on its own; make every change in both.
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_started = time.time()
+_spans = defaultdict(lambda: {"count": 0, "total_s": 0.0, "max_s": 0.0})
+_counters = Counter()
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def reset():
+    global _started
+    with _lock:
+        _started = time.time()
+        _spans.clear()
+        _counters.clear()
+
+
+def count(name, n=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += n
+
+
+def record_span(name, seconds, **labels):
+    with _lock:
+        s = _spans[_key(name, labels)]
+        s["count"] += 1
+        s["total_s"] += seconds
+        s["max_s"] = max(s["max_s"], seconds)
+
+
+@contextmanager
+def span(name, **labels):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - t0, **labels)
+
+
+def api_execute(method, request):
+    """
+    Executes a googleapiclient request, recording the call, its latency and
+    any HTTP error status under `method` (e.g. "documents.batchUpdate").
+    """
+    count("api_calls", method=method)
+    try:
+        with span("api", method=method):
+            return request.execute()
+    except Exception as e:
+        # HttpError carries the response; anything else is recorded as status None
+        status = getattr(getattr(e, "resp", None), "status", None)
+        count("api_errors", method=method, status=str(status))
+        if status == 429:
+            count("rate_limited", method=method)
+        raise
+
+
+def report():
+    with _lock:
+        spans = [
+            {"name": name, "labels": dict(labels),
+             "count": s["count"], "total_s": round(s["total_s"], 6), "max_s": round(s["max_s"], 6)}
+            for (name, labels), s in sorted(_spans.items())
+        ]
+        counters = [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(_counters.items())
+        ]
+    return {
+        "started": _started,
+        "finished": time.time(),
+        "duration_s": round(time.time() - _started, 6),
+        "spans": spans,
+        "counters": counters,
+    }
+
+
+def _prom_labels(labels):
+    if not labels:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+    return "{" + body + "}"
+
+
+def _prom_name(prefix, name):
+    return f"{prefix}_{name}".replace(".", "_").replace("-", "_")
+
+
+def prometheus_text(rep, prefix="kb_pipeline"):
+    lines = [f"{prefix}_run_duration_seconds {rep['duration_s']}",
+             f"{prefix}_run_finished_timestamp_seconds {rep['finished']:.0f}"]
+    for s in rep["spans"]:
+        labels = dict(s["labels"], span=s["name"])
+        lines.append(f"{prefix}_span_seconds_total{_prom_labels(labels)} {s['total_s']}")
+        lines.append(f"{prefix}_span_count_total{_prom_labels(labels)} {s['count']}")
+    for c in rep["counters"]:
+        lines.append(f"{_prom_name(prefix, c['name'])}_total{_prom_labels(c['labels'])} {c['value']}")
+    return "\n".join(lines) + "\n"
+
+
+def _atomic_write(path, text):
+    # textfile collectors may read mid-write, so write aside and rename
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def write_report(path, prom_path=None, prefix="kb_pipeline"):
+    rep = report()
+    if path:
+        _atomic_write(path, json.dumps(rep, indent=2))
+    if prom_path:
+        _atomic_write(prom_path, prometheus_text(rep, prefix))
+    return rep
+
+
+def summary(rep=None):
+    """Short human-readable summary of the slowest spans and the counters."""
+    rep = rep or report()
+    lines = [f"Run took {rep['duration_s']:.1f}s"]
+    for s in sorted(rep["spans"], key=lambda s: -s["total_s"])[:10]:
+        labels = ",".join(f"{k}={v}" for k, v in s["labels"].items())
+        lines.append(f"  {s['name']}{'[' + labels + ']' if labels else ''}: "
+                     f"{s['total_s']:.2f}s over {s['count']} calls")
+    for c in rep["counters"]:
+        labels = ",".join(f"{k}={v}" for k, v in c["labels"].items())
+        lines.append(f"  {c['name']}{'[' + labels + ']' if labels else ''} = {c['value']}")
+    return "\n".join(lines)
@@ -0,0 +1,85 @@
+"""
+Run-scoped, size-bounded LRU caches for Google Drive metadata.
+
+Each script run is one process, so the module-level caches below live exactly
+as long as a run; nothing is persisted. Callers must invalidate an entry after
+changing the object it describes (moving or deleting a file):
+
+    meta = file_cache.get_or_load(file_id, lambda: fetch_parents(file_id))
+    ...files().update(fileId=file_id, addParents=...)...
+    invalidate_file(file_id)
+
+Document bodies are deliberately not cached: every read of a doc is followed
+by our own write to it, so a cached copy would never be served.
+"""
+import threading
+from collections import OrderedDict
+
+from instrumentation import count
+
+_MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, name, maxsize=1024):
+        self.name = name
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                count("cache_misses", cache=self.name)
+                return default
+            self._data.move_to_end(key)
+            count("cache_hits", cache=self.name)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                count("cache_evictions", cache=self.name)
+
+    def get_or_load(self, key, loader):
+        """Returns the cached value or stores and returns `loader()`; errors are not cached."""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.put(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+# files().get() parents/trashed metadata by file ID; None means 404
+file_cache = LRUCache("files", maxsize=4096)
+# Spreadsheet ID by (folder ID, title), from the Drive folder search
+spreadsheet_id_cache = LRUCache("spreadsheet_ids", maxsize=64)
+
+
+def invalidate_file(file_id):
+    """Drops everything cached about `file_id`; call after moving or deleting it."""
+    file_cache.invalidate(file_id)
+
+
+def clear_all():
+    for cache in (file_cache, spreadsheet_id_cache):
+        cache.clear()
@@ -5,24 +5,110 @@ from bs4 import BeautifulSoup
 from socket import gethostname
 import pandas as pd
 import os
-def denodo_database(driver_path, credential_user_id, credential_password, server_name, jdbc_port, server_database, query):
+import argparse
+from datetime import datetime
+from instrumentation import count, span, summary, write_report
+
+# Run report (JSON) and optional Prometheus textfile-collector output
+RUN_REPORT = os.environ.get("KB_RUN_REPORT", "services_run_report.json")
+PROM_TEXTFILE = os.environ.get("KB_PROM_TEXTFILE")
+
+OUTPUT_FOLDER = "Denodo_services"
+CLOSED_AFTER = datetime(2023, 1, 1)
+FETCH_BATCH_SIZE = 5000
+# Tickets with a NULL servicename (only possible with --all-services) go here
+NO_SERVICE_FILE = "_no_servicename.csv"
+
+# Per-ticket rows with their update bodies aggregated; {filters} is filled with
+# bind-parameter placeholders only, never with values.
+SERVICE_QUERY = """
+SELECT tv.ticketid, tv.title, tv.servicename, tv.description,
+    LISTAGG(iu.iu_body, ' || ') WITHIN GROUP (ORDER BY iu.iu_datecreated) AS aggregated_iu_body
+FROM dw_tdx.ticketsview tv
+Left JOIN dw_tdx.itemupdates iu
+ON tv.ticketid = iu.iu_itemid
+WHERE tv.appid = 31 {filters}
+GROUP BY tv.ticketid, tv.title, tv.servicename, tv.description
+"""
+
+COLUMNS = ["Ticket_ID", "Title", "Servicename", "Description", "Feed"]
+
+
+def denodo_connect(driver_path, credential_user_id, credential_password, server_name, jdbc_port, server_database):
     conn_uri = f"jdbc:denodo://{server_name}:{jdbc_port}/{server_database}?userAgent={dbdriver.__name__}-{gethostname()}"
-    cnxn = dbdriver.connect(
+    return dbdriver.connect(
         "com.denodo.vdp.jdbc.Driver",
         conn_uri,
         driver_args={"useKerberos": "true", "user": credential_user_id, "password": credential_password, "ssl": "true"},
         jars=driver_path
     )
 
+
+def denodo_database(driver_path, credential_user_id, credential_password, server_name, jdbc_port, server_database, query, params=None):
+    cnxn = denodo_connect(driver_path, credential_user_id, credential_password, server_name, jdbc_port, server_database)
+
     cur = cnxn.cursor()
-    cur.execute(query)
-    results = cur.fetchall()
+    with span("denodo.query"):
+        cur.execute(query, params)
+        results = cur.fetchall()
+    count("rows_fetched", len(results))
     cnxn.close()
     return results
 
+
+def stream_query(cnxn, query, params=None, batch_size=FETCH_BATCH_SIZE):
+    """Yields result batches of up to `batch_size` rows from one query."""
+    cur = cnxn.cursor()
+    try:
+        with span("denodo.query"):
+            cur.execute(query, params)
+        while True:
+            with span("denodo.fetch"):
+                batch = cur.fetchmany(batch_size)
+            if not batch:
+                break
+            count("rows_fetched", len(batch))
+            yield batch
+    finally:
+        cur.close()
+
+
+def build_service_query(service_names=None, closed_from=CLOSED_AFTER, closed_to=None):
+    """
+    Returns (sql, params) for SERVICE_QUERY restricted to `service_names`
+    (None = every service) and to tickets closed in (closed_from, closed_to].
+    """
+    filters, params = [], []
+    if service_names is not None:
+        filters.append(f"tv.servicename IN ({', '.join('?' for _ in service_names)})")
+        params.extend(service_names)
+    filters.append("tv.closeddate > CAST(? AS TIMESTAMP)")
+    params.append(closed_from.strftime("%Y-%m-%d %H:%M:%S"))
+    if closed_to is not None:
+        filters.append("tv.closeddate <= CAST(? AS TIMESTAMP)")
+        params.append(closed_to.strftime("%Y-%m-%d %H:%M:%S"))
+    return SERVICE_QUERY.format(filters="".join(f"AND {f} " for f in filters)), params
+
+
+def closeddate_partitions(n, start=CLOSED_AFTER, end=None):
+    """Splits (start, end] into `n` equal closeddate windows; the last one is open-ended."""
+    if n < 1:
+        raise ValueError(f"need at least one closeddate partition, got {n}")
+    end = end or datetime.now()
+    step = (end - start) / n
+    bounds = [start + step * i for i in range(n)] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def service_output_file(output_folder, service_name):
+    return os.path.join(output_folder, f"{service_name}.csv".replace(" ", ""))  # Dropping spaces from filenames
+
+
 # Convert raw results into a DataFrame
 def creating_dataframe(results):
-    df = pd.DataFrame(results, columns=["Ticket_ID", "Title", "Servicename", "Description", "Feed"])
+    df = pd.DataFrame.from_records(results, columns=COLUMNS)
+    df["Ticket_ID"] = pd.to_numeric(df["Ticket_ID"], downcast="integer")
+    df["Servicename"] = df["Servicename"].astype("category")
     df["Description"] = df["Description"].apply(clean_html)
     df["Feed"] = df["Feed"].apply(clean_html)
     return df
@@ -31,19 +117,101 @@ def creating_dataframe(results):
 def clean_html(html):
     if pd.isna(html) or html is None:  # Handle None or NaN values
         return ""
-    soup = BeautifulSoup(html, 'html.parser')
-    return soup.get_text(separator=' ', strip=True)
+    with span("html.clean"):
+        soup = BeautifulSoup(html, 'html.parser')
+        return soup.get_text(separator=' ', strip=True)
 
 # Print the results (for debugging)
 def print_results(results):
     print(results)
 
+
+def export_per_service(connect_args, service_names, output_folder=OUTPUT_FOLDER):
+    """One query per service, as originally run; kept for spot re-exports."""
+    os.makedirs(output_folder, exist_ok=True)
+    for service_name in service_names:
+        query, params = build_service_query([service_name])
+
+        # Execute query
+        results = denodo_database(*connect_args, query, params)
+
+        # Convert results to DataFrame
+        df_results = creating_dataframe(results)
+
+        # Save results to a CSV file, named dynamically based on the service
+        output_file = service_output_file(output_folder, service_name)
+        with span("csv.write"):
+            df_results.to_csv(output_file, index=False)
+        count("bytes_written", os.path.getsize(output_file))
+        count("services_exported")
+
+        print(f"Saved results for service: {service_name} -> {output_file}")
+
+
+def export_single_query(connect_args, service_names=None, partitions=1,
+                        output_folder=OUTPUT_FOLDER, batch_size=FETCH_BATCH_SIZE):
+    """
+    Runs one query per closeddate partition (one in total by default) covering
+    every requested service, streams the result and appends each batch to the
+    per-service CSVs. With `service_names=None` every service is exported.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    written = set()
+    cnxn = denodo_connect(*connect_args)
+    try:
+        for closed_from, closed_to in closeddate_partitions(partitions):
+            query, params = build_service_query(service_names, closed_from, closed_to)
+            for batch in stream_query(cnxn, query, params, batch_size):
+                df_batch = creating_dataframe(batch)
+                groups = list(df_batch.groupby("Servicename", sort=False, observed=True))
+                # groupby drops NULL service names; keep those tickets in their own file
+                no_service = df_batch[df_batch["Servicename"].isna()]
+                if len(no_service):
+                    count("tickets_without_service", len(no_service))
+                    groups.append((None, no_service))
+                for service_name, df_service in groups:
+                    output_file = (os.path.join(output_folder, NO_SERVICE_FILE) if service_name is None
+                                   else service_output_file(output_folder, service_name))
+                    first = output_file not in written
+                    with span("csv.write"):
+                        df_service.to_csv(output_file, mode="w" if first else "a",
+                                          header=first, index=False)
+                    written.add(output_file)
+    finally:
+        cnxn.close()
+
+    # Services without tickets still get a (header-only) file, as per-service mode did
+    for service_name in service_names or []:
+        output_file = service_output_file(output_folder, service_name)
+        if output_file not in written:
+            pd.DataFrame(columns=COLUMNS).to_csv(output_file, index=False)
+            written.add(output_file)
+
+    for output_file in sorted(written):
+        count("bytes_written", os.path.getsize(output_file))
+        count("services_exported")
+        print(f"Saved results -> {output_file}")
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Export closed tickets from Denodo into one CSV per service.")
+    parser.add_argument("--mode", choices=["single", "per-service"], default="single",
+                        help="one streamed query for all services (default) or one query per service")
+    parser.add_argument("--all-services", action="store_true",
+                        help="single mode only: export every service instead of those in the services CSV")
+    parser.add_argument("--partitions", type=int, default=1,
+                        help="single mode only: split the closeddate range into this many queries")
+    parser.add_argument("--batch-size", type=int, default=FETCH_BATCH_SIZE)
+    args = parser.parse_args()
+    if args.partitions < 1:
+        parser.error("--partitions must be at least 1")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+
 # Load the service names from the CSV file
     service_csv_file = "ticketsview_Services.csv"  # Update with the correct file path
     service_df = pd.read_csv(service_csv_file)
     service_names = service_df['servicename'].tolist()  # Assuming column name is 'servicename'
- # Example list of service names
     # Denodo connection details (ensure credentials are correctly defined in credential.py)
     credential_password = credential.db_password
     credential_user_id = credential.db_user
@@ -51,38 +219,20 @@ def main():
     denodoserver_name = "denodo.it.umich.edu"
     denodoserver_jdbc_port = "9999"
     denodoserver_database = "gateway"
+    connect_args = (denododriver_path, credential_user_id, credential_password,
+                    denodoserver_name, denodoserver_jdbc_port, denodoserver_database)
 
-    # Function to execute the query for each service
-    for service_name in service_names:
-        output_folder = "Denodo_services"
-
-
-        os.makedirs(output_folder, exist_ok=True)
-        query = f"""
-        SELECT tv.ticketid, tv.title, tv.servicename, tv.description, 
-            LISTAGG(iu.iu_body, ' || ') WITHIN GROUP (ORDER BY iu.iu_datecreated) AS aggregated_iu_body
-        FROM dw_tdx.ticketsview tv
-        Left JOIN dw_tdx.itemupdates iu
-        ON tv.ticketid = iu.iu_itemid
-        WHERE tv.appid = 31 AND tv.servicename = '{service_name}' AND tv.closeddate > TIMESTAMP '2023-01-01 00:00:00.000'
-        GROUP BY tv.ticketid, tv.title, tv.servicename, tv.description;
-        """
-
-        # Execute query
-        results = denodo_database(denododriver_path, credential_user_id, credential_password, 
-                                denodoserver_name, denodoserver_jdbc_port, denodoserver_database, query)
-        
-        # Convert results to DataFrame
-        df_results = creating_dataframe(results)
-        
-        # Save results to a CSV file, named dynamically based on the service
-        output_file = os.path.join(output_folder, f"{service_name}.csv".replace(" ", ""))  # Replacing spaces with underscores for filenames
-        df_results.to_csv(output_file, index=False)
-
-        print(f"Saved results for service: {service_name} -> {output_file}")
+    if args.mode == "per-service":
+        export_per_service(connect_args, service_names)
+    else:
+        export_single_query(connect_args,
+                            None if args.all_services else service_names,
+                            partitions=args.partitions,
+                            batch_size=args.batch_size)
 
     print("All queries executed successfully!")
+    print(summary(write_report(RUN_REPORT, prom_path=PROM_TEXTFILE)))
+
 
-    
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()